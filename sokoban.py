@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-# -1: invalid
+# -1: invalid (stored as 0xff in the map grid)
 #  0: wall
 #  1: open space
 #
@@ -17,9 +17,10 @@
 #   4: left
 
 import array
-import copy
 from enum import Enum
 
+INVALID = 0xff
+
 m =   [[0,    0,    0,    0,    0,    0],
        [0,    1,    1,    1, 0x21,    0],
        [0,    1, 0x21,    1, 0x11,    0],
@@ -46,7 +47,27 @@ class Dir(Enum):
     DOWN = 3
     LEFT = 4
 
+# (dx, dy) of each direction, indexed by direction value - 1
+DELTAS = ((0, -1), (1, 0), (0, 1), (-1, 0))
+
+def flood_fill(free, start, width):
+    '''find all cells reachable from start through free cells (bitmask of flat indices), return them as a bitmask
+    together with the smallest one
+
+    it's the innermost loop of the search, so the region is grown one step in all 4 directions at once with shifts on
+    the bitmasks, the per-cell work runs inside the int operations instead of the interpreter. free cells are never on
+    the border of the map, so shifting by 1 never wraps into another row'''
+    reach = 1 << start
+    while True:
+        grown = (reach | (reach << 1) | (reach >> 1) | (reach << width) | (reach >> width)) & free
+        if grown == reach:
+            return reach, (reach & -reach).bit_length() - 1
+        reach = grown
+
 class skb_map(object):
+    __slots__ = ('height', 'width', 'array', 'neighbors', 'dead_mask', 'open_mask', 'walls_mask', 'dests',
+                 'box', 'dest', 'boxes', 'unsolved', 'character', 'reachable', '_key')
+
     def __init__(self, mapl):
         '''init from an 2d array (trailing -1 for each row may be omitted)'''
         self.height = len(mapl)
@@ -59,46 +80,125 @@ class skb_map(object):
             l = len(i)
             flatten.extend(i)
             flatten.extend([-1] * (self.width - l))
-        self.array = array.array('i', flatten)
-
-        self.validate()
+        self.array = bytearray(INVALID if e == -1 else e for e in flatten)
+        self.boxes = 0
+        self.character = None
+
+        self.resolve_neighbors()
+        self.resolve_dead_corners()
+        self.validate()   # before dead squares are added, only boxes in dead corners make the map invalid
+        self.resolve_dead_squares()
+        self.resolve_state()
         self.resolve_reachable()
 
+    def resolve_state(self):
+        '''move boxes and destinations out of the grid into bitmasks of flat indices, the grid only keeps the static part
+        (walls and open spaces) and is never modified during the search'''
+        self.boxes = 0
+        self.dests = 0
+        self.open_mask = 0
+        self.walls_mask = 0
+        for i, e in enumerate(self.array):
+            if e == 0 or e == INVALID:   # invalid space is as good as a wall for boxes
+                self.walls_mask |= 1 << i
+                continue
+            self.open_mask |= 1 << i
+            if (e & 0x40) != 0:
+                self.boxes |= 1 << i
+            if (e & 0x20) != 0:
+                self.dests |= 1 << i
+            self.array[i] = e & ~0x50
+
     def element(self, x, y):
         '''return the element at a coordinate'''
-        return self.array[x + y * self.width]
-
-    def update_element(self, x, y, value):
-        '''update the element at a coordinate'''
-        self.array[x + y * self.width] = value
+        i = x + y * self.width
+        e = self.array[i]
+        if (self.boxes >> i) & 1:
+            e |= 0x40
+        if (x, y) == self.character:
+            e |= 0x10
+        return e
 
     def is_reachable(self, x, y):
         '''whether the coordinate is reachable from the current character position'''
-        return self.reachable[x + y * self.width] & 0x80 == 0x80
-
-    def is_blocked(self, x, y):
-        '''whether the coordinate is blocked (cannot move in, by wall or box)'''
-        return self.element(x, y) == 0 or (self.element(x, y) & 0x40) == 0x40
+        return (self.reachable >> (x + y * self.width)) & 1 == 1
 
     def is_wall(self, x, y):
         '''whether the coordinate is wall'''
         return self.element(x, y) == 0
 
-    def is_dead_corner(self, x, y):
-        '''whether the coordinate is a dead corner (i.e. if moved to here, cannot get out)'''
-        if self.element(x, y) & 0x20 != 0:   # a destination is not a dead corner
-            return False
+    def is_dead_square(self, x, y):
+        '''whether the coordinate is a dead corner (i.e. if moved to here, cannot get out) or a dead square (a box here can
+        never reach any destination)'''
+        return (self.dead_mask >> (x + y * self.width)) & 1 == 1
+
+    def resolve_neighbors(self):
+        '''flat index of the 4 neighbors (up, right, down, left) of each cell, -1 if out of the map'''
+        w = self.width
+        h = self.height
+        neighbors = []
+        for y in range(h):
+            for x in range(w):
+                i = x + y * w
+                neighbors.append(i - w if y > 0 else -1)
+                neighbors.append(i + 1 if x < w-1 else -1)
+                neighbors.append(i + w if y < h-1 else -1)
+                neighbors.append(i - 1 if x > 0 else -1)
+        self.neighbors = array.array('i', neighbors)
+
+    def resolve_dead_corners(self):
+        '''find all dead corners, they only depend on walls and destinations so it's done once per puzzle'''
+        self.dead_mask = 0
+        for y in range(1, self.height-1):
+            for x in range(1, self.width-1):
+                e = self.element(x, y)
+                if e == 0 or e == INVALID or (e & 0x20) != 0:   # only open space, a destination is not a dead corner
+                    continue
 
-        if (self.is_wall(x+1, y) and self.is_wall(x, y+1)) or \
-            (self.is_wall(x+1, y) and self.is_wall(x, y-1)) or \
-            (self.is_wall(x-1, y) and self.is_wall(x, y+1)) or \
-            (self.is_wall(x-1, y) and self.is_wall(x, y-1)):
-            return True
-        return False
+                if (self.is_wall(x+1, y) and self.is_wall(x, y+1)) or \
+                    (self.is_wall(x+1, y) and self.is_wall(x, y-1)) or \
+                    (self.is_wall(x-1, y) and self.is_wall(x, y+1)) or \
+                    (self.is_wall(x-1, y) and self.is_wall(x, y-1)):
+                    self.dead_mask |= 1 << (x + y * self.width)
+
+    def resolve_dead_squares(self):
+        '''find all cells from which a box can never reach any destination, by pulling boxes backward from all destinations'''
+        grid = self.array
+        neighbors = self.neighbors
+        live = bytearray(len(grid))
+        todo = [i for i, e in enumerate(grid) if e != INVALID and (e & 0x20) != 0]
+        for i in todo:
+            live[i] = 1
 
-    def compare(self, another_map):
-        '''if 2 maps are equivalent (same box positions and equivalent character position'''
-        return self.reachable == another_map.reachable
+        while (todo):
+            i = todo.pop()
+            for d in range(4):
+                p = neighbors[i*4 + d]   # the box is pulled from i to p
+                if p < 0 or grid[p] == 0 or grid[p] == INVALID or live[p]:
+                    continue
+                q = neighbors[p*4 + d]   # the character is stepping back from p to q
+                if q < 0 or grid[q] == 0 or grid[q] == INVALID:
+                    continue
+                live[p] = 1
+                todo.append(p)
+
+        for i, e in enumerate(grid):
+            if e != 0 and e != INVALID and not live[i]:
+                self.dead_mask |= 1 << i
+
+    def is_frozen(self, i, n):
+        '''whether pushing the box at flat index i to flat index n makes a 2x2 block of walls and boxes with any box not on
+        destination, none of these boxes can be moved anymore'''
+        w = self.width
+        boxes = self.boxes ^ ((1 << i) | (1 << n))
+        blocked = self.walls_mask | boxes
+        unsolved = boxes & ~self.dests
+        square = 3 | (3 << w)   # a 2x2 block with its top left cell at 0
+        for corner in (n, n-1, n-w, n-w-1):   # top left cell of each 2x2 block containing the new location
+            block = square << corner
+            if blocked & block == block and unsolved & block:
+                return True
+        return False
 
     def completed(self):
         '''it's fully solved'''
@@ -107,12 +207,13 @@ class skb_map(object):
     def print(self, reachable=False):
         for y in range(self.height):
             for x in range(self.width):
-                if not reachable:
-                    e = self.element(x, y)
-                else:
-                    e = self.reachable[x + y * self.width]
+                e = self.element(x, y)
+                if reachable and e != INVALID:
+                    e &= ~0x10
+                    if self.is_reachable(x, y):
+                        e |= 0x80
 
-                if e == -1:
+                if e == INVALID:
                     p = '     '
                 elif e < 0x10:
                     p = '{:5d}'.format(e)
@@ -123,8 +224,8 @@ class skb_map(object):
             print('\n')
         print('box: {}, unsolved: {}, character: ({}, {})'.format(self.box, self.unsolved, self.character[0], self.character[1]))
 
-    def validate(self, no_update=False):
-        '''check if the map is valid'''
+    def validate(self):
+        '''check if the map is valid, only done for the initial map, maps derived by moves are trusted'''
         total_box = 0
         total_dest = 0
         total_unsolved = 0
@@ -134,7 +235,7 @@ class skb_map(object):
         for y in range(self.height):
             for x in range(self.width):
                 e = self.element(x, y)
-                if e == 0 or e == -1:    # walls and invalid space are not interested
+                if e == 0 or e == INVALID:    # walls and invalid space are not interested
                     continue
 
                 if (e & 1) == 0 or (e & ~0x71) != 0:   # any special flags on non open space, or any unexpected flags (undefined or reachable)
@@ -145,7 +246,7 @@ class skb_map(object):
                     print('open space on the border at {}, {}'.format(x, y))
                     exit(-1)
 
-                if (e & 0x1) == 1 and (self.element(x-1, y) == -1 or self.element(x+1, y) == -1 or self.element(x, y-1) == -1 or self.element(x, y+1) == -1):
+                if (e & 0x1) == 1 and (self.element(x-1, y) == INVALID or self.element(x+1, y) == INVALID or self.element(x, y-1) == INVALID or self.element(x, y+1) == INVALID):
                     print('open space adjacent to invalid at {}, {}'.format(x, y))
                     exit(-1)
 
@@ -160,7 +261,7 @@ class skb_map(object):
                     total_box += 1
                     if (e & 0x20) == 0:
                         total_unsolved += 1
-                    if self.is_dead_corner(x, y):
+                    if self.is_dead_square(x, y):   # only dead corners are known at this point
                         print('unmovable box at {}, {}'.format(x, y))
                         exit(-1)
 
@@ -180,108 +281,89 @@ class skb_map(object):
             print('boxes and destinations don''t match')
             exit(-1)
 
-        if no_update:
-            if self.box != total_box or self.dest != total_dest or self.unsolved != total_unsolved:
-                print('inconsistent box/dest/unsolved count')
-                exit(-1)
-            if self.character != character:
-                print('inconsistent character data')
-                exit(-1)
-        else:
-            self.box = total_box
-            self.dest = total_dest
-            self.unsolved = total_unsolved
-            self.character = character
+        self.box = total_box
+        self.dest = total_dest
+        self.unsolved = total_unsolved
+        self.character = character
 
     def resolve_reachable(self):
         '''find all reachable spots'''
-        self.reachable = copy.copy(self.array)
-
-        # starting from character point, clear the character flag for easy comparison of equivalence
         x, y = self.character
-        self.reachable[x + y * self.width] &= ~0x10
-        todo = set([(x, y)])
+        self.reachable, min_idx = flood_fill(self.open_mask & ~self.boxes, x + y * self.width, self.width)
 
-        def check_xy(x, y):
-            t = self.reachable[x + y * self.width]
-            if t != 0 and (t & 0x40) == 0 and (t & 0x80) == 0:   # not wall, not box, not already counted as reachable
-                todo.add((x, y))
-        while (todo):
-            x, y = todo.pop()
-            self.reachable[x + y * self.width] |= 0x80
-            check_xy(x+1, y)
-            check_xy(x-1, y)
-            check_xy(x, y+1)
-            check_xy(x, y-1)
+        # fingerprint of the frame, 2 maps are equivalent (same box positions and equivalent character position) if keys match,
+        # with the same boxes the reachable regions are disjoint, so the smallest reachable cell identifies the region.
+        # both are packed into a single int, cheaper to hash than a tuple (maps are way smaller than 2^16 cells)
+        self._key = (self.boxes << 16) | min_idx
 
     def find_all_possible_moves(self):
         '''find all possible moves, return a list of (x, y, direction)'''
-        moves = []
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.element(x, y) == -1 or (self.element(x, y) & 0x40) == 0:  # not a box
-                    continue
-                if self.is_reachable(x, y+1) and not self.is_blocked(x, y-1) and not self.is_dead_corner(x, y-1):
-                    moves.append((x, y, Dir.UP))
-                if self.is_reachable(x-1, y) and not self.is_blocked(x+1, y) and not self.is_dead_corner(x+1, y):
-                    moves.append((x, y, Dir.RIGHT))
-                if self.is_reachable(x, y-1) and not self.is_blocked(x, y+1) and not self.is_dead_corner(x, y+1):
-                    moves.append((x, y, Dir.DOWN))
-                if self.is_reachable(x+1, y) and not self.is_blocked(x-1, y) and not self.is_dead_corner(x-1, y):
-                    moves.append((x, y, Dir.LEFT))
-        return moves
-
-    def create_new_map_by_move(self, x, y, direction):
-        '''retrun a new map after move'''
+        w = self.width
+        boxes = self.boxes
+        reach = self.reachable
+        free = self.open_mask & ~boxes & ~self.dead_mask   # cells a box can be pushed onto
+        is_frozen = self.is_frozen
+
+        # for each direction, shift the masks so that bit i tells about the cells behind and ahead of a box at i,
+        # all the boxes are checked at once, only the candidates are checked one by one
+        candidates = []
+        for d, (dx, dy) in zip(Dir, DELTAS):
+            k = dx + dy * w
+            if k > 0:
+                mask = boxes & (reach << k) & (free >> k)
+            else:
+                mask = boxes & (reach >> -k) & (free << -k)
+            while mask:
+                low = mask & -mask
+                mask ^= low
+                i = low.bit_length() - 1
+                if not is_frozen(i, i + k):
+                    candidates.append((i, d.value, (i % w, i // w, d)))
+
+        # keep the grid scan order, box by box
+        candidates.sort()
+        return [c[2] for c in candidates]
+
+    def apply_move(self, x, y, direction):
+        '''apply a move in place, return the undo information (box old/new index, character, unsolved, reachable, key)'''
 
         # 0. minimal sanity check only
-        new_map = copy.deepcopy(self)
-        if (new_map.element(x, y) & 0x40) == 0:
+        i = x + y * self.width
+        if (self.boxes >> i) & 1 == 0:
             print('bad move attemp ({}, {}), {}, no box'.format(x, y, direction))
             exit(-1)
 
-        # 1. erase character
-        cx, cy = new_map.character
-        new_map.update_element(cx, cy, new_map.element(cx, cy) & ~0x10)
-
-        # 2. clear the box from current location, if we are moving away from a destination, update unsolved count
-        new_map.update_element(x, y, new_map.element(x, y) & ~0x40)
-        if (new_map.element(x, y) & 0x20) != 0:
-            new_map.unsolved += 1
-
-        # 3. update the box to the new location (update unsolved accordingly)
-        nx = x
-        ny = y
-        if direction == Dir.UP:
-            ny = y - 1
-        elif direction == Dir.RIGHT:
-            nx = x + 1
-        elif direction == Dir.DOWN:
-            ny = y + 1
-        elif direction == Dir.LEFT:
-            nx = x - 1
-        else:
-            print('bad move direction ({}, {}), {}'.format(x, y, direction))
-            exit(-1)
+        # 1. find the new location of the box
+        dx, dy = DELTAS[direction.value - 1]
+        n = i + dx + dy * self.width
+
+        undo = (i, n, self.character, self.unsolved, self.reachable, self._key)
 
-        new_map.update_element(nx, ny, new_map.element(nx, ny) | 0x40)
-        if (new_map.element(nx, ny) & 0x20) != 0:
-            new_map.unsolved -= 1
+        # 2. move the box, if we are moving away from / onto a destination, update unsolved count
+        self.boxes ^= (1 << i) | (1 << n)
+        if (self.dests >> i) & 1:
+            self.unsolved += 1
+        if (self.dests >> n) & 1:
+            self.unsolved -= 1
 
-        # 4. set new character position and resolve reachable
-        new_map.character = (x, y)
-        new_map.update_element(x, y, new_map.element(x, y) | 0x10)
-        new_map.resolve_reachable()
+        # 3. set new character position and resolve reachable
+        self.character = (x, y)
+        self.resolve_reachable()
 
-        # it should be a valid map now, check to make sure, not necessary
-        new_map.validate(True)
+        return undo
 
-        return new_map
+    def undo_move(self, undo):
+        '''revert a move done by apply_move'''
+        i, n, self.character, self.unsolved, self.reachable, self._key = undo
+        self.boxes ^= (1 << i) | (1 << n)
 
-# each level:  [skbmap, all_moves, current move]
+# the map is updated in place along the search path
+#   history, each level:  [all_moves, current move]
+#   undos, undo information of the move leading to each level except the first one
 def find_skb_map_solutions(skbmap):
     history = []
-    seen = [skbmap]
+    undos = []
+    seen = {skbmap._key}
     moves = 0
     solutions = 0
 
@@ -289,42 +371,43 @@ def find_skb_map_solutions(skbmap):
         print('already resolved')
         return
 
-    history.append([skbmap, skbmap.find_all_possible_moves(), -1])
+    history.append([skbmap.find_all_possible_moves(), -1])
 
     while (history):
         h = history[-1]
 
-        h[2] += 1     # ready to try next move
-        if h[2] >= len(h[1]):   # we are done with all the moves in current layer
+        h[1] += 1     # ready to try next move
+        if h[1] >= len(h[0]):   # we are done with all the moves in current layer
             history.pop()
+            if undos:
+                skbmap.undo_move(undos.pop())
             continue
 
         moves += 1
 
-        x, y, dir = h[1][h[2]]
-        nm = h[0].create_new_map_by_move(x, y, dir)
-        if nm.completed():
+        x, y, dir = h[0][h[1]]
+        undo = skbmap.apply_move(x, y, dir)
+        if skbmap.completed():
             print('solution (move count {}):'.format(len(history)))
             for t in history:
-                print('\t', t[1][t[2]])
+                print('\t', t[0][t[1]])
             solutions += 1
 
         # we still want to add the solution map into seen as well (they may also differ due to character possibly at different position)
-        rep = False
-        for s in seen:
-            if nm.compare(s):   # we already seen this frame, this is not a valid path
-                rep = True
-                break
-        if rep:
+        if skbmap._key in seen:   # we already seen this frame, this is not a valid path
+            skbmap.undo_move(undo)
             continue
 
-        seen.append(nm)
+        seen.add(skbmap._key)
 
-        if nm.completed():
+        if skbmap.completed():
+            skbmap.undo_move(undo)
             continue
 
-        # a new valid non-solution frame
-        history.append([nm, nm.find_all_possible_moves(), -1])
+        # a new valid non-solution frame, seen frames are never expanded again so moves are generated only once per frame
+        # (no point caching them by the frame key)
+        undos.append(undo)
+        history.append([skbmap.find_all_possible_moves(), -1])
 
     print('moves evaluated: {}, solutions found: {}, frames seen: {}'.format(moves, solutions, len(seen)))
 